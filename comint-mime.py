@@ -8,24 +8,26 @@ def __COMINT_MIME_setup(types):
         print("`comint-mime' error: IPython is required")
         return
 
-    from base64 import encodebytes
-    from functools import partial
+    try:
+        from pybase64 import b64encode
+    except ImportError:
+        from base64 import b64encode
+    from binascii import a2b_base64
     from json import dumps as to_json
-
-    def encoding_workaround(data):
-        if isinstance(data, str):
-            from base64 import decodebytes
-            return decodebytes(data.encode())
-        return data
+    from tempfile import mkstemp
+    import os
+    import sys
 
     SIZE_LIMIT = 4000
+    OSC_START = b"\033]5151;"
+    OSC_END = b"\033\\\n"
 
     MIME_TYPES = {
-        "image/png": encoding_workaround,
-        "image/jpeg": encoding_workaround,
-        "text/latex": str.encode,
-        "text/html": str.encode,
-        "application/json": lambda d: to_json(d).encode(),
+        "image/png": None,
+        "image/jpeg": None,
+        "text/latex": None,
+        "text/html": None,
+        "application/json": to_json,
     }
 
     if types == "all":
@@ -33,28 +35,119 @@ def __COMINT_MIME_setup(types):
     else:
         types = types.split(";")
 
-    def print_osc(type, encoder, data, meta):
-        meta = meta or {}
-        if encoder:
-            data = encoder(data)
-        header = to_json({**meta, "type": type})
-        if len(data) > SIZE_LIMIT:
-            from tempfile import mkstemp
-            fdesc, fname = mkstemp()
-            with open(fdesc, "wb") as f: f.write(data)
-            payload = "tmpfile://" + fname
+    def osc_header(header):
+        return OSC_START + to_json(header).encode() + b"\n"
+
+    def write_all(fd, data):
+        data = memoryview(data)
+        while data:
+            data = data[os.write(fd, data):]
+
+    def tmpfile_url(data):
+        fdesc, fname = mkstemp()
+        if isinstance(data, str):
+            # Let the file object encode large text chunk by chunk
+            with open(fdesc, "w", encoding="utf-8", newline="") as f:
+                f.write(data)
         else:
-            payload = encodebytes(data).decode()
-        print(f"\033]5151;{header}\n{payload}\033\\")
+            try:
+                write_all(fdesc, data)
+            finally:
+                os.close(fdesc)
+        return ("tmpfile://" + fname).encode()
+
+    def make_print_osc(type, encoder):
+        default_header = osc_header({"type": type})
+        # IPython may pass binary data as a base64 string
+        preencoded = type.startswith("image/")
+
+        def print_osc(data, meta):
+            if encoder:
+                data = encoder(data)
+            if meta:
+                header = osc_header({**meta, "type": type})
+            else:
+                header = default_header
+            if preencoded and isinstance(data, str):
+                if len(data) > SIZE_LIMIT * 4 // 3:
+                    payload = tmpfile_url(a2b_base64(data))
+                else:
+                    payload = data.encode()
+            else:
+                # SIZE_LIMIT counts bytes.  A string with more characters
+                # is over it anyway; otherwise measure its UTF-8 form.
+                if isinstance(data, str) and len(data) <= SIZE_LIMIT:
+                    data = data.encode()
+                if len(data) > SIZE_LIMIT:
+                    payload = tmpfile_url(data)
+                else:
+                    payload = b64encode(data)
+            sys.stdout.flush()
+            try:
+                fd = sys.stdout.fileno()
+            except (AttributeError, OSError):  # Not backed by a file
+                buffer = getattr(sys.stdout, "buffer", None)
+                if buffer is None:  # E.g. redirected to a StringIO
+                    print((header + payload + OSC_END).decode(), end="")
+                else:
+                    buffer.write(header)
+                    buffer.write(payload)
+                    buffer.write(OSC_END)
+                    buffer.flush()
+                return
+            write_all(fd, header)
+            write_all(fd, payload)
+            write_all(fd, OSC_END)
+
+        return print_osc
 
     ipython.enable_matplotlib("inline")
-    ipython.display_formatter.active_types = list(MIME_TYPES.keys())
+    from IPython.core.pylabtools import print_figure, retina_figure
+    from matplotlib.figure import Figure
+    from matplotlib_inline.config import InlineBackend
+    from zlib import Z_RLE
+
+    png_printer = None
+
+    # Make the inline backend's PNGs fast to encode, on top of the user's
+    # InlineBackend configuration.  IPython drops this whenever it resets
+    # the Figure formatters, so check again before each cell.
+    def setup_png_formatter(*_):
+        nonlocal png_printer
+        formatter = ipython.display_formatter.formatters["image/png"]
+        if png_printer and formatter.type_printers.get(Figure) is png_printer:
+            return
+        config = InlineBackend.instance(parent=ipython)
+        formats = set(config.figure_formats)
+        kwargs = dict(config.print_figure_kwargs)
+        # Inline figures are transient, so favor speed over PNG
+        # compression.  Plots are mostly runs of flat color, where Z_RLE
+        # does about as well as a full DEFLATE search.
+        kwargs["pil_kwargs"] = {"compress_level": 1, "compress_type": Z_RLE,
+                                **kwargs.get("pil_kwargs", {})}
+        if "retina" in formats or "png2x" in formats:
+            def png_printer(fig):
+                return retina_figure(fig, **kwargs)
+        elif "png" in formats:
+            def png_printer(fig):
+                return print_figure(fig, "png", **kwargs)
+        else:
+            return
+        formatter.for_type(Figure, png_printer)
+
+    setup_png_formatter()
+    name = setup_png_formatter.__qualname__  # Replace hooks of earlier setups
+    for callback in ipython.events.callbacks["pre_run_cell"][:]:
+        if getattr(callback, "__qualname__", None) == name:
+            ipython.events.unregister("pre_run_cell", callback)
+    ipython.events.register("pre_run_cell", setup_png_formatter)
+    ipython.display_formatter.active_types = list(MIME_TYPES)
     for mime, encoder in MIME_TYPES.items():
         ipython.display_formatter.formatters[mime].enabled = mime in types
-        ipython.mime_renderers[mime] = partial(print_osc, mime, encoder)
+        ipython.mime_renderers[mime] = make_print_osc(mime, encoder)
 
     if types:
         print("`comint-mime' enabled for",
-              ", ".join(t for t in types if t in MIME_TYPES.keys()))
+              ", ".join(t for t in types if t in MIME_TYPES))
     else:
         print("`comint-mime' disabled")